@@ -7,6 +7,11 @@ class Settings(BaseSettings):
     base_path: str = "."
     retry_count: int = 3
     retry_delay: int = 3
+    pool_size: int = 64
+    request_timeout: int = 10
+    io_workers: int = 8
+    scrape_concurrency: int = 64
+    page_cache_path: str = "./page_cache.json"
 
 
 settings = Settings()
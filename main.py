@@ -1,14 +1,37 @@
 from fastapi import FastAPI, Header, HTTPException
-import requests
-from bs4 import BeautifulSoup, Tag
+import aiohttp
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from http import HTTPStatus
+from selectolax.lexbor import LexborHTMLParser
 from pydantic import BaseModel
 import os
 import json
-import urllib.parse
+import hashlib
+import hmac
+import orjson
 import re
-import time
 from config import settings
 
+# Matches everything apart from the word characters and whitespaces.
+_SPECIAL_CHARS_RE = re.compile(r"[^\w\s_]")
+
+# The amount of an image buffered in memory before it is written out.
+_IMAGE_BUFFER_SIZE = 1 << 20
+
+
+@lru_cache(maxsize=4096)
+def _clean_title(text: str):
+    """Memoized removal of the special characters, see ScrapeService.remove_special_chars."""
+    return _SPECIAL_CHARS_RE.sub("", text)
+
+
+@lru_cache(maxsize=4096)
+def _image_path(base_path: str, title: str):
+    """Memoized image path computation, see FileSystemRepository.image_path."""
+    return os.path.join(base_path, title + ".jpg")
+
 
 class ScrapeRequest(BaseModel):
     """The request contract for the scraping request.
@@ -25,7 +48,7 @@ class ScrapeRequest(BaseModel):
 class Repository:
     """An abstract class providing general methods for persisting data."""
 
-    def save_obj(self, obj):
+    async def save_obj(self, obj):
         """Saves the object on the specified system.
 
         Args:
@@ -33,47 +56,160 @@ class Repository:
         """
         pass
 
-    def save_image(self, img):
-        """Saves the image object on the specified system.
+    async def save_image_chunks(self, title: str, chunks):
+        """Saves the image streamed in chunks on the specified system.
 
         Args:
-            img (any): The image object which needs to be saved.
+            title (str): The title of the product to which the image belongs.
+            chunks (AsyncIterator[bytes]): The chunks of the image content, in order.
         """
         pass
 
+    def close(self):
+        """Releases the resources held by the repository."""
+        pass
+
 
 class FileSystemRepository(Repository):
     """File system backed repository
 
     Attributes:
         base_path: A string representing the base path for saving objects and other things
+        io_pool: A ThreadPoolExecutor running the blocking file writes, so they overlap with the network I/O.
     """
 
     base_path: str
+    io_pool: ThreadPoolExecutor
 
-    def __init__(self, base_path: str) -> None:
+    def __init__(self, base_path: str, io_workers: int) -> None:
         self.base_path = base_path
+        self.io_pool = ThreadPoolExecutor(max_workers=io_workers)
         super().__init__()
 
-    def save_obj(self, obj):
+    async def save_obj(self, obj):
         """Saves the object specified in the specified filesystem location in the JSON format.
 
+        The object is serialized with orjson and written out in a single task on the io pool.
+
         Args:
             obj (any): An object which needs to be saved.
         """
         path = os.path.join(self.base_path, obj["product_title"] + ".json")
         obj["path_to_image"] = self.image_path(obj["product_title"])
-        with open(path, "w") as jsonfile:
-            json.dump(obj, jsonfile)
+        data = orjson.dumps(obj)
+        await asyncio.get_running_loop().run_in_executor(
+            self.io_pool, self.write_file, path, data
+        )
+
+    def write_file(self, path: str, data: bytes):
+        """Writes the data to the file at the path, replacing any previous content only once all of it is written.
+
+        Args:
+            path (str): The path of the file.
+            data (bytes): The content of the file.
+        """
+        temp_path = self.temp_path(path)
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.finish_file(fd, data, temp_path, path)
+
+    async def save_image_chunks(self, title: str, chunks):
+        """Saves the image to the filesystem as its chunks arrive, holding at most about a megabyte of it in memory.
+
+        An image which fits in the buffer is opened, written and closed in a single task on the io pool,
+        a larger one is written out on the io pool each time the buffer fills up. Either way the image is
+        written aside and only moved in place of the previous one once complete.
+
+        Args:
+            title (str): The title of the product to which the image belongs.
+            chunks (AsyncIterator[bytes]): The chunks of the image content, in order.
+        """
+        loop = asyncio.get_running_loop()
+        path = self.image_path(title)
+        temp_path = self.temp_path(path)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        buffer = bytearray()
+        fd = None
+        try:
+            async for chunk in chunks:
+                buffer += chunk
+                if len(buffer) >= _IMAGE_BUFFER_SIZE:
+                    if fd is None:
+                        fd = await loop.run_in_executor(
+                            self.io_pool, os.open, temp_path, flags, 0o644
+                        )
+                    data, buffer = buffer, bytearray()
+                    await loop.run_in_executor(self.io_pool, self.write_fd, fd, data)
+            if fd is None:
+                # Also creates the empty file of an empty body, which the product points to
+                await loop.run_in_executor(self.io_pool, self.write_file, path, buffer)
+            else:
+                last_fd, fd = fd, None
+                await loop.run_in_executor(
+                    self.io_pool, self.finish_file, last_fd, buffer, temp_path, path
+                )
+        finally:
+            if fd is not None:
+                # The stream failed midway, the previous image stays as it was
+                try:
+                    await loop.run_in_executor(
+                        self.io_pool, self.discard_file, fd, temp_path
+                    )
+                except RuntimeError:
+                    # The io pool is already shut down
+                    self.discard_file(fd, temp_path)
+
+    def finish_file(self, fd: int, data: bytes, temp_path: str, path: str):
+        """Writes the last of the data to the temporary file, closes it and moves it in place of the file at the path.
 
-    def save_image(self, img):
-        """Saves the image specified to the filesystem.
+        Args:
+            fd (int): The file descriptor of the temporary file.
+            data (bytes): The remaining content of the file.
+            temp_path (str): The path of the temporary file.
+            path (str): The path of the file.
+        """
+        try:
+            self.write_fd(fd, data)
+        except OSError:
+            self.discard_file(fd, temp_path)
+            raise
+        os.close(fd)
+        os.replace(temp_path, path)
+
+    def discard_file(self, fd: int, temp_path: str):
+        """Closes and removes a temporary file which did not get completely written.
 
         Args:
-            img (any): An image object which needs to be saved.
+            fd (int): The file descriptor of the temporary file.
+            temp_path (str): The path of the temporary file.
         """
-        with open(self.image_path(img["title"]), "wb") as f:
-            f.write(img["content"])
+        os.close(fd)
+        os.remove(temp_path)
+
+    def temp_path(self, path: str):
+        """Computes the path where the file at the path is written before being moved in place.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            str: The path of the temporary file.
+        """
+        return path + ".part"
+
+    def write_fd(self, fd: int, data: bytes):
+        """Writes all of the data to the file descriptor, as a single os.write may write only a part of it.
+
+        Args:
+            fd (int): The file descriptor opened for writing.
+            data (bytes): The data to be written.
+        """
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+
+    def close(self):
+        """Waits for the pending writes and shuts the io pool down."""
+        self.io_pool.shutdown()
 
     def image_path(self, title: str):
         """Computes the image path for the product being saved.
@@ -84,7 +220,13 @@ class FileSystemRepository(Repository):
         Returns:
             str: The path of the file system where the image object is saved.
         """
-        return os.path.join(self.base_path, title + ".jpg")
+        return _image_path(self.base_path, title)
+
+
+class PageNotModified(Exception):
+    """Raised when the content on a url is unchanged since it was last retrieved."""
+
+    pass
 
 
 class ProductGateway:
@@ -93,32 +235,126 @@ class ProductGateway:
     Attributes:
         retry_count: An integer representing the number of retries we are to perform should there be any error while getting the response.
         succ_delay: An integer (seconds) representing the the delay between the successive requests in the retry.
+        pool_size: An integer representing the maximum number of pooled connections kept open simultaneously.
+        request_timeout: An integer (seconds) representing the time allowed for connecting, and for each read of a response.
+        page_cache: A PageCacheService keeping the validators of the pages retrieved before.
+        session: An aiohttp ClientSession shared by all the requests, created lazily within the running event loop.
     """
 
     retry_count: int
     succ_delay: int
+    pool_size: int
+    request_timeout: int
+    page_cache: "PageCacheService"
+    session: aiohttp.ClientSession
 
-    def __init__(self, retry_count: int, succ_delay: int) -> None:
+    def __init__(
+        self,
+        retry_count: int,
+        succ_delay: int,
+        pool_size: int,
+        request_timeout: int,
+        page_cache: "PageCacheService",
+    ) -> None:
         self.retry_count = retry_count
         self.succ_delay = succ_delay
+        self.pool_size = pool_size
+        self.request_timeout = request_timeout
+        self.page_cache = page_cache
+        self.session = None
 
-    def retrieve(self, url):
-        """Retrieves the content on the url.
+    def get_session(self):
+        """Gets the session used for sending the requests, creating it on the first use.
+
+        Returns:
+            aiohttp.ClientSession: The session with a pooled connector.
+        """
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.pool_size, keepalive_timeout=30
+                ),
+                # Bounds each connect and each read, not the wait for a pooled connection or the whole body
+                timeout=aiohttp.ClientTimeout(
+                    total=None,
+                    sock_connect=self.request_timeout,
+                    sock_read=self.request_timeout,
+                ),
+            )
+        return self.session
+
+    async def close(self):
+        """Closes the session along with its pooled connections."""
+        if self.session is not None:
+            await self.session.close()
+
+    async def retrieve(self, url):
+        """Retrieves the content on the url, conditionally on it having changed since the last retrieval.
+
+        The validators of the new content are only returned, it is for the caller to record them in the page cache
+        once it is done with the content.
 
         Args:
             url (str): A String representing the url to be used for the retrieving the content.
 
+        Raises:
+            PageNotModified: When the server answers 304, or the content hashes the same as the last time.
+            aiohttp.ClientResponseError: When the retries ran out without a successful response.
+
         Returns:
-            content : The contents on the specified url.
+            tuple: The contents on the specified url and their validators.
         """
-        response = self.get_response(url)
-        return response.content
+        validators = self.page_cache.validators(url)
+        headers = {}
+        if validators.get("etag") is not None:
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified") is not None:
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+        response = await self.get_response(url, headers)
+        async with response:
+            if response.status == HTTPStatus.NOT_MODIFIED:
+                raise PageNotModified(url)
+            # The retries ran out, an error page is neither parsed nor validated against the next time
+            response.raise_for_status()
+            content = await response.read()
+
+        digest = hashlib.sha256(content).hexdigest()
+        if validators.get("sha256") == digest:
+            raise PageNotModified(url)
+        new_validators = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "sha256": digest,
+        }
+        return (content, new_validators)
+
+    async def stream(self, url, chunk_size: int = 65536):
+        """Streams the content on the url in chunks.
 
-    def get_response(self, url):
+        Args:
+            url (str): A String representing the url to be used for the retrieving the content.
+            chunk_size (int, optional): The maximum size (bytes) of a single chunk.
+
+        Raises:
+            aiohttp.ClientResponseError: When the retries ran out without a successful response.
+
+        Yields:
+            bytes: The successive chunks of the contents on the specified url.
+        """
+        response = await self.get_response(url)
+        async with response:
+            # An error body is not the image
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(chunk_size):
+                yield chunk
+
+    async def get_response(self, url, headers: dict = None):
         """Gets the response from the url specified
 
         Args:
             url (str): url which is to be used for making the requests.
+            headers (dict, optional): Additional headers to be sent with the request.
 
         Returns:
             response : Response from the specified url, None if do not able to get anything.
@@ -127,11 +363,14 @@ class ProductGateway:
         response = None
 
         while current_count <= self.retry_count and (
-            response == None or response.status_code != requests.codes.ok
+            response is None
+            or response.status not in (HTTPStatus.OK, HTTPStatus.NOT_MODIFIED)
         ):
-            if response != None:
-                time.sleep(self.succ_delay)
-            response = requests.get(url)
+            if response is not None:
+                response.release()
+                await asyncio.sleep(self.succ_delay)
+            response = await self.get_session().get(url, headers=headers)
+            current_count += 1
         return response
 
 
@@ -202,6 +441,14 @@ class CacheService:
         """
         return self.cache[key]
 
+    def remove(self, key: str):
+        """Removes the key, along with its value, if it exists in the cache.
+
+        Args:
+            key (str): The key which is to be removed.
+        """
+        self.cache.pop(key, None)
+
 
 class ProductCacheService(CacheService):
     """Product Cache Service."""
@@ -222,6 +469,43 @@ class ProductCacheService(CacheService):
         return (not self.contains(key)) or self.get(key) != val
 
 
+class PageCacheService(CacheService):
+    """Page Cache Service, keyed by the url of the page."""
+
+    def __init__(self) -> None:
+        super().__init__()
+
+    def validators(self, url: str):
+        """Gets the validators recorded when the page was last retrieved.
+
+        Args:
+            url (str): The url of the page.
+
+        Returns:
+            dict: The etag, last_modified and sha256 of the page, empty if it was never retrieved.
+        """
+        return self.get(url) if self.contains(url) else {}
+
+    def load(self, path: str):
+        """Loads the validators persisted at the path, if any.
+
+        Args:
+            path (str): The path of the JSON file holding the validators.
+        """
+        if os.path.exists(path):
+            with open(path) as jsonfile:
+                self.cache.update(json.load(jsonfile))
+
+    def dump(self, path: str):
+        """Persists the validators at the path in the JSON format.
+
+        Args:
+            path (str): The path of the JSON file holding the validators.
+        """
+        with open(path, "w") as jsonfile:
+            json.dump(self.cache, jsonfile)
+
+
 class ScrapeService:
     """Scrapes the Product Information.
 
@@ -230,12 +514,14 @@ class ScrapeService:
         gateway: Gateway through which we send the requests and get the response.
         notification_service: A NotificationService to notify users.
         cache_service: A CacheService, which caches the product details.
+        fetch_slots: A Semaphore bounding the number of pages and products being fetched at once.
     """
 
     repository: Repository
     gateway: ProductGateway
     notification_service: NotificationService
     cache_service: CacheService
+    fetch_slots: asyncio.Semaphore
 
     def __init__(
         self,
@@ -243,15 +529,19 @@ class ScrapeService:
         gateway: ProductGateway,
         notification_service: NotificationService,
         cache_service: CacheService,
+        concurrency: int,
     ) -> None:
         self.repository = repository
         self.gateway = gateway
         self.notification_service = notification_service
         self.cache_service = cache_service
+        self.fetch_slots = asyncio.Semaphore(concurrency)
 
-    def scrape(self, scrape_request: ScrapeRequest):
+    async def scrape(self, scrape_request: ScrapeRequest):
         """Scrapes the product information.
 
+        All the pages are scraped concurrently, each one through its own pipeline of fetching, parsing and saving.
+
         Args:
             scrape_request (ScrapeRequest): The request for the scraping.
 
@@ -261,86 +551,135 @@ class ScrapeService:
         num_pages = scrape_request.pages
         url = scrape_request.url
 
-        products = []
-        product_images = []
-
-        for page_num in range(1, num_pages + 1):
-            current_url = urllib.parse.urljoin(url, str(page_num))
-            print(current_url)
-            current_products_response = self.gateway.retrieve(current_url)
-            current_products, current_product_images = self.process_products(
-                current_products_response
-            )
-            print(len(current_products))
-            products.extend(current_products)
-            product_images.extend(current_product_images)
-
-        # Save the Products
-        for product in products:
-            self.repository.save_obj(product)
-
-        # Save the Images
-        for image in product_images:
-            self.repository.save_image(image)
+        # The pages are numbered right under the url
+        base_url = url if url.endswith("/") else url + "/"
+        page_urls = [base_url + str(page_num) for page_num in range(1, num_pages + 1)]
+        page_updates = await asyncio.gather(
+            *[self.scrape_page(page_url) for page_url in page_urls]
+        )
+        product_updates = sum(page_updates)
 
         # Notifying for the update
         self.notification_service.notify(
-            "Number of products updated: " + str(len(products))
+            "Number of products updated: " + str(product_updates)
         )
-        return len(products)
+        return product_updates
 
-    def process_products(self, products_response):
-        """Processes the products on a particular page.
+    async def scrape_page(self, page_url: str):
+        """Scrapes the product information on a single page.
+
+        The page is parsed in the default executor so that the event loop stays free for other requests,
+        then every updated product is saved right away along with its image, without holding the products
+        of the other pages. A product which fails to be saved is left out, and retried on the next scrape.
 
         Args:
-            products_response (content): Product detail over the page.
+            page_url (str): The url of the page which is to be scraped.
 
         Returns:
-            tuple: Product and its corresponding images.
+            int: Number of products updated on the page.
         """
+        try:
+            async with self.fetch_slots:
+                products_response, validators = await self.gateway.retrieve(page_url)
+        except PageNotModified:
+            # Nothing on the page changed since the last scrape
+            print(page_url + " not modified")
+            return 0
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(page_url + " failed: " + repr(e))
+            return 0
+        print(page_url)
+
+        # Parsing is CPU bound, so keep it off the event loop
+        product_details = await asyncio.get_running_loop().run_in_executor(
+            None, self.process_products, products_response
+        )
 
-        soup = BeautifulSoup(products_response, "html.parser")
+        # The cache is checked and updated here on the event loop, so the pages do not race on it
+        saves = []
+        for raw_product_name, product_price, image_url in product_details:
+            # Checked on the raw name, so nothing else is computed for the unchanged products
+            if not self.cache_service.is_val_diff(raw_product_name, product_price):
+                continue
+            self.cache_service.put(raw_product_name, product_price)
+
+            current_product = {}
+            current_product["product_title"] = self.remove_special_chars(
+                raw_product_name
+            )
+            current_product["product_price"] = product_price
+            saves.append(
+                self.save_product(raw_product_name, current_product, image_url)
+            )
 
-        target_class = "products columns-4"
-        product_list = soup.find(class_=target_class)
+        saved = await asyncio.gather(*saves)
+        print(str(sum(saved)) + " of " + str(len(saved)))
 
-        products = []
-        product_images = []
+        # Only once all of its products got saved is the page known to be unchanged the next time
+        if all(saved):
+            self.gateway.page_cache.put(page_url, validators)
+        return sum(saved)
 
-        for product in product_list:
-            if type(product) == Tag:
-                product_image_detail = product.find_all("img")[1]
-                product_price_detail = 0.0
-                if product.find("bdi") != None:
-                    product_price_detail = float(list(product.find("bdi").children)[1])
-                # Name
-                current_product_name = self.remove_special_chars(
-                    product_image_detail.get("title")
-                )
-                current_product_price = product_price_detail
+    async def save_product(self, raw_product_name: str, product: dict, image_url: str):
+        """Saves the image of the product, and then the product itself so that it only ever points to a saved image.
 
-                if not self.cache_service.is_val_diff(
-                    current_product_name, current_product_price
-                ):
-                    continue
+        Args:
+            raw_product_name (str): The name of the product as it appears on the page, its key in the cache.
+            product (dict): The product which is to be saved.
+            image_url (str): The url of the image of the product.
 
-                current_product = {}
-                current_product["product_title"] = self.remove_special_chars(
-                    product_image_detail.get("title")
+        Returns:
+            bool: Indicates whether the product got saved or not.
+        """
+        try:
+            async with self.fetch_slots:
+                await self.repository.save_image_chunks(
+                    product["product_title"], self.gateway.stream(image_url)
                 )
-                current_product["product_price"] = product_price_detail
+                await self.repository.save_obj(product)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            print(product["product_title"] + " failed: " + repr(e))
+            # Forgotten, so the product is picked up again on the next scrape
+            self.cache_service.remove(raw_product_name)
+            return False
+        return True
 
-                image_url = product_image_detail.get("src")
-                current_product_image = {}
-                current_product_image["title"] = current_product["product_title"]
-                current_product_image["content"] = self.gateway.retrieve(image_url)
+    def process_products(self, products_response):
+        """Processes the products on a particular page.
 
-                products.append(current_product)
-                product_images.append(current_product_image)
+        Only parses the page, it is left to the caller to check the products against the cache.
 
-                self.cache_service.put(current_product_name, current_product_price)
+        Args:
+            products_response (content): Product detail over the page.
+
+        Returns:
+            list: The name, as it appears on the page, the price and the image url of every product having both
+                a name and an image url.
+        """
+
+        tree = LexborHTMLParser(products_response)
+
+        # Only the product cards placed directly under the product list
+        target_selector = ".products.columns-4 > li.product"
 
-        return (products, product_images)
+        product_details = []
+
+        for product in tree.css(target_selector):
+            product_image_detail = product.css("img")[1].attributes
+            raw_product_name = product_image_detail.get("title")
+            image_url = product_image_detail.get("src")
+            # Without a name or an image there is nothing which could be saved
+            if not raw_product_name or not image_url:
+                continue
+            product_price_detail = 0.0
+            price_detail = product.css_first("bdi")
+            if price_detail is not None:
+                # The amount is the text of bdi itself, next to the currency symbol span
+                product_price_detail = float(price_detail.text(deep=False, strip=True))
+
+            product_details.append((raw_product_name, product_price_detail, image_url))
+
+        return product_details
 
     def remove_special_chars(self, text):
         """Removes the special characters from a text.
@@ -351,26 +690,37 @@ class ScrapeService:
         Returns:
             str: String without the special characters.
         """
-        regex = r"[^\w\s_]"
-        return re.sub(regex, "", text)
+        return _clean_title(text)
 
 
 # Initializing various components
 
 # The repository
-file_system_repository = FileSystemRepository(settings.base_path)
+file_system_repository = FileSystemRepository(settings.base_path, settings.io_workers)
+# The page cache
+page_cache = PageCacheService()
 # The gateway
-product_gateway = ProductGateway(settings.retry_count, settings.retry_delay)
+product_gateway = ProductGateway(
+    settings.retry_count,
+    settings.retry_delay,
+    settings.pool_size,
+    settings.request_timeout,
+    page_cache,
+)
 # The notification service
 notification_service = SimpleConsoleNotificationService()
 # The product cache
 product_cache = ProductCacheService()
 # The scraping service (All components DIed into it)
 scrape_service = ScrapeService(
-    file_system_repository, product_gateway, notification_service, product_cache
+    file_system_repository,
+    product_gateway,
+    notification_service,
+    product_cache,
+    settings.scrape_concurrency,
 )
-# The token cache
-token_cache = CacheService()
+# The valid tokens, all the single digit values
+valid_tokens = frozenset(str(num).encode() for num in range(10))
 
 app = FastAPI()
 
@@ -392,7 +742,7 @@ async def scrape(scrape_request: ScrapeRequest, token: str = Header(default=None
     if not validate_token(token):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    product_updates = scrape_service.scrape(scrape_request=scrape_request)
+    product_updates = await scrape_service.scrape(scrape_request=scrape_request)
     return "{product_updates:" + str(product_updates) + "}"
 
 
@@ -405,11 +755,22 @@ def validate_token(token: str):
     Returns:
         bool: Indicating whether the token passed is valid or not.
     """
-    return token != None and token_cache.contains(token)
+    if token is None:
+        return False
+    # Compared in constant time, so the timing does not leak the valid tokens
+    token = token.encode()
+    return any(hmac.compare_digest(token, valid_token) for valid_token in valid_tokens)
 
 
 @app.on_event("startup")
 async def startup():
-    """Initializes the token cache for all the single digit values."""
-    for num in range(10):
-        token_cache.put(str(num), "User" + str(num))
+    """Loads the page cache."""
+    page_cache.load(settings.page_cache_path)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Closes the pooled connections of the gateway and the repository, and persists the page cache."""
+    await product_gateway.close()
+    file_system_repository.close()
+    page_cache.dump(settings.page_cache_path)